@@ -6,18 +6,25 @@
 # -- Project information -----------------------------------------------------
 # https://www.sphinx-doc.org/en/master/usage/configuration.html#project-information
 
-import itertools
+import hashlib
 import os
 import re
+import tempfile
+import weakref
 import zlib
 from pathlib import Path
 from typing import Any, Callable, Iterable, Literal, NamedTuple
 
+import docutils.utils
+from docutils import nodes
+from docutils.nodes import fully_normalize_name
+from docutils.parsers.rst import Parser
 from sphinx import addnodes
 from sphinx.application import Sphinx
 from sphinx.domains import Domain, ObjType
 from sphinx.roles import XRefRole
 from sphinx.environment import BuildEnvironment
+from sphinx.transforms import SphinxTransform
 from pygments.lexer import inherit, words
 from pygments.lexers.c_cpp import CppLexer  # type: ignore
 from pygments import token
@@ -58,65 +65,77 @@ class InvItem(NamedTuple):
     "Display name for the object, if different from the link ref"
 
 
-CPPREF_INVENTORY: list[InvItem] = [
-    # We add a "std__" prefix to the link name for items in the `std`
-    # namespace, because the cpp domain will not otherwise attempt to resolve any
-    # names that live in the `std::` namespace. Use the `disp_name` to show the
-    # proper name of the item instead.
-    # XXX: also that hyperlinking seems to fail for templates when template arguments are provided?
-    InvItem(
-        ["std__coroutine_handle"],
-        "cpp:class",
-        "cpp/coroutine/coroutine_handle",
-        "std::coroutine_handle",
-    ),
-    InvItem(["std__coroutine_traits"], "cpp:class", "cpp/coroutine/coroutine_traits", "std::coroutine_traits"),
-    InvItem(["std__suspend_never"], "cpp:class", "cpp/coroutine/suspend_never", "std::suspend_never"),
-    InvItem(["std__suspend_always"], "cpp:class", "cpp/coroutine/suspend_always", "std::suspend_always"),
-    InvItem(["std__bad_alloc"], "cpp:class", "cpp/memory/new/bad_alloc", "std::bad_alloc"),
-    InvItem(["std__error_code"], "cpp:class", "cpp/error/error_code", "std::error_code"),
-    InvItem(["std__system_error"], "cpp:class", "cpp/error/system_error", "std::system_error"),
-    InvItem(["std__errc"], "cpp:enum", "cpp/error/errc", "std::errc"),
-    InvItem(["std__exception_ptr"], "cpp:class", "cpp/error/exception_ptr", "std::exception_ptr"),
-    InvItem(["std__string_view"], "cpp:type", "cpp/string/basic_string_view", "std::string_view"),
-    InvItem(["std__string"], "cpp:type", "cpp/string/basic_string", "std::string"),
-    InvItem(["std__move"], "cpp:function", "cpp/utility/move", "std::move"),
-    InvItem(["std__forward"], "cpp:function", "cpp/utility/forward", "std::forward"),
-    InvItem(["size_t"], "cpp:type", "c/types/size_t"),
-    InvItem(["std__size_t"], "cpp:type", "cpp/types/size_t", "std::size_t"),
-    InvItem(["ptrdiff_t"], "cpp:type", "c/types/ptrdiff_t"),
-    InvItem(["std__ptrdiff_t"], "cpp:type", "cpp/types/ptrdiff_t", "std::ptrdiff_t"),
-    InvItem(["std__byte"], "cpp:type", "cpp/types/byte", "std::byte"),
-    InvItem(["std__forward_iterator"], "cpp:concept", "cpp/iterator/forward_iterator", "std::forward_iterator"),
-    InvItem(["std__ranges__forward_range"], "cpp:concept", "cpp/ranges/forward_range", "std::ranges::forward_range"),
-    InvItem(["timespec"], "cpp:class", "c/chrono/timespec"),
-    InvItem(["c/language/value_category"], "std:doc", "c/language/value_category", "Value categories (C)"),
-    InvItem(["c/preprocessor/replace"], "std:doc", "c/preprocessor/replace", "Replacing test macros (C)"),
-    InvItem(["cpp/language/value_category"], "std:doc", "cpp/language/value_category", "Value categories (C++)"),
-    InvItem(["cpp/language/language_linkage"], "std:doc", "cpp/language/language_linkage", "Language linkage (C++)"),
-    InvItem(
-        ["cpp/language/elaborated_type_specifier"],
-        "std:doc",
-        "cpp/language/elaborated_type_specifier",
-        "Elaborated type specifier (C++)",
-    ),
-    *itertools.chain.from_iterable(
-        (
-            InvItem([itype], "cpp:type", "c/types/integer", itype),
-            InvItem([f"std__{itype}"], "cpp:type", "cpp/types/integer", f"std::{itype}"),
-        )
-        for itype in (
-            "int8_t",
-            "uint8_t",
-            "int16_t",
-            "uint16_t",
-            "int32_t",
-            "uint32_t",
-            "int64_t",
-            "uint64_t",
-        )
-    ),
-]
+def _build_inventory() -> list[InvItem]:
+    """
+    Create the list of cppreference objects that we link to. This is only called when the
+    generated inventory is out-of-date.
+    """
+    inv = [
+        # We add a "std__" prefix to the link name for items in the `std`
+        # namespace, because the cpp domain will not otherwise attempt to resolve any
+        # names that live in the `std::` namespace. Use the `disp_name` to show the
+        # proper name of the item instead.
+        # XXX: also that hyperlinking seems to fail for templates when template arguments are provided?
+        InvItem(
+            ["std__coroutine_handle"],
+            "cpp:class",
+            "cpp/coroutine/coroutine_handle",
+            "std::coroutine_handle",
+        ),
+        InvItem(["std__coroutine_traits"], "cpp:class", "cpp/coroutine/coroutine_traits", "std::coroutine_traits"),
+        InvItem(["std__suspend_never"], "cpp:class", "cpp/coroutine/suspend_never", "std::suspend_never"),
+        InvItem(["std__suspend_always"], "cpp:class", "cpp/coroutine/suspend_always", "std::suspend_always"),
+        InvItem(["std__bad_alloc"], "cpp:class", "cpp/memory/new/bad_alloc", "std::bad_alloc"),
+        InvItem(["std__error_code"], "cpp:class", "cpp/error/error_code", "std::error_code"),
+        InvItem(["std__system_error"], "cpp:class", "cpp/error/system_error", "std::system_error"),
+        InvItem(["std__errc"], "cpp:enum", "cpp/error/errc", "std::errc"),
+        InvItem(["std__exception_ptr"], "cpp:class", "cpp/error/exception_ptr", "std::exception_ptr"),
+        InvItem(["std__string_view"], "cpp:type", "cpp/string/basic_string_view", "std::string_view"),
+        InvItem(["std__string"], "cpp:type", "cpp/string/basic_string", "std::string"),
+        InvItem(["std__move"], "cpp:function", "cpp/utility/move", "std::move"),
+        InvItem(["std__forward"], "cpp:function", "cpp/utility/forward", "std::forward"),
+        InvItem(["size_t"], "cpp:type", "c/types/size_t"),
+        InvItem(["std__size_t"], "cpp:type", "cpp/types/size_t", "std::size_t"),
+        InvItem(["ptrdiff_t"], "cpp:type", "c/types/ptrdiff_t"),
+        InvItem(["std__ptrdiff_t"], "cpp:type", "cpp/types/ptrdiff_t", "std::ptrdiff_t"),
+        InvItem(["std__byte"], "cpp:type", "cpp/types/byte", "std::byte"),
+        InvItem(["std__forward_iterator"], "cpp:concept", "cpp/iterator/forward_iterator", "std::forward_iterator"),
+        InvItem(
+            ["std__ranges__forward_range"],
+            "cpp:concept",
+            "cpp/ranges/forward_range",
+            "std::ranges::forward_range",
+        ),
+        InvItem(["timespec"], "cpp:class", "c/chrono/timespec"),
+        InvItem(["c/language/value_category"], "std:doc", "c/language/value_category", "Value categories (C)"),
+        InvItem(["c/preprocessor/replace"], "std:doc", "c/preprocessor/replace", "Replacing test macros (C)"),
+        InvItem(["cpp/language/value_category"], "std:doc", "cpp/language/value_category", "Value categories (C++)"),
+        InvItem(
+            ["cpp/language/language_linkage"],
+            "std:doc",
+            "cpp/language/language_linkage",
+            "Language linkage (C++)",
+        ),
+        InvItem(
+            ["cpp/language/elaborated_type_specifier"],
+            "std:doc",
+            "cpp/language/elaborated_type_specifier",
+            "Elaborated type specifier (C++)",
+        ),
+    ]
+    for itype in (
+        "int8_t",
+        "uint8_t",
+        "int16_t",
+        "uint16_t",
+        "int32_t",
+        "uint32_t",
+        "int64_t",
+        "uint64_t",
+    ):
+        inv.append(InvItem([itype], "cpp:type", "c/types/integer", itype))
+        inv.append(InvItem([f"std__{itype}"], "cpp:type", "cpp/types/integer", f"std::{itype}"))
+    return inv
 
 
 def generate_sphinx_inventory(
@@ -131,36 +150,75 @@ def generate_sphinx_inventory(
     The Sphinx inventory format is under-documented, but seems to be fairly stable.
     See: https://sphobjinv.readthedocs.io/en/stable/syntax.html
     """
-    dat = zlib.compress(
-        b"".join(
-            b"".join(f"{refname} {i.role} 1 {i.path} {i.disp_name or refname}\n".encode() for refname in i.refnames)
-            for i in items
-        )
-    )
-    newdat = (
-        b"# Sphinx inventory version 2\n"
-        + f"# Project: {project_name}\n".encode()
-        + f"# Version: {project_version}\n".encode()
-        + b"# The remainder of this file is compressed using zlib.\n"
-        + dat
-    )
     out_inv = Path(out_inv)
+    # All inventory content is ASCII, so build the text in one piece and encode it once
+    lines = [f"{refname} {i.role} 1 {i.path} {i.disp_name or refname}\n" for i in items for refname in i.refnames]
+    payload = "".join(lines).encode("ascii")
+    # Write to a temporary file and move it into place, so that a reader never sees a partial inventory
+    tmp = tempfile.NamedTemporaryFile(dir=out_inv.parent, prefix=f".{out_inv.name}.", delete=False)
     try:
-        cur = out_inv.read_bytes()
-    except FileNotFoundError:
-        cur = b""
-    if newdat != cur:
-        out_inv.write_bytes(newdat)
+        with tmp:
+            tmp.write(
+                b"# Sphinx inventory version 2\n"
+                + f"# Project: {project_name}\n".encode()
+                + f"# Version: {project_version}\n".encode()
+                + b"# The remainder of this file is compressed using zlib.\n"
+            )
+            tmp.write(zlib.compress(payload))
+        # The temporary file is created private (0600), and os.replace() keeps that mode
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, out_inv)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+def _stamp_key() -> str:
+    """
+    Compute the key for stamping the generated inventory. The inventory content is defined in this
+    file, so a digest of this file stands in for a digest of the inventory itself.
+    """
+    return hashlib.blake2b(Path(__file__).read_bytes()).hexdigest()
 
 
-CPPREF_GENERATED_INV = "cppref.generated.inv"
-generate_sphinx_inventory(CPPREF_GENERATED_INV, "cppreference", "0", CPPREF_INVENTORY)
+def _stamp_matches(stamp: os.PathLike[str] | str, key: str) -> bool:
+    """
+    Determine whether the given stamp file is current. The stamp records the key along with the
+    modification time and size of the stamped file (the stamp's path without the ``.stamp`` suffix),
+    so an up-to-date file is detected with a single ``stat()`` and without reading the file.
+    """
+    stamp = Path(stamp)
+    try:
+        mtime_ns, size, stamp_key = stamp.read_text().split()
+        st = os.stat(stamp.with_suffix(""))
+    except (FileNotFoundError, ValueError):
+        return False
+    return (int(mtime_ns), int(size), stamp_key) == (st.st_mtime_ns, st.st_size, key)
+
 
+def _write_stamp(stamp: os.PathLike[str] | str, key: str) -> None:
+    "Write a stamp file for the file that it stamps. See `_stamp_matches`"
+    stamp = Path(stamp)
+    st = os.stat(stamp.with_suffix(""))
+    stamp.write_text(f"{st.st_mtime_ns} {st.st_size} {key}\n")
+
+
+CPPREF_GENERATED_INV = "cppref.generated.inv"
+_CPPREF_STAMP_KEY = _stamp_key()
+if not _stamp_matches(CPPREF_GENERATED_INV + ".stamp", _CPPREF_STAMP_KEY):
+    generate_sphinx_inventory(CPPREF_GENERATED_INV, "cppreference", "0", _build_inventory())
+    _write_stamp(CPPREF_GENERATED_INV + ".stamp", _CPPREF_STAMP_KEY)
+
+# Remote inventories are fetched concurrently (Sphinx ≥ 7.3). Local copies in `_inv/` are tried before the
+# network. These are local-only (ignored by Git): create or refresh them with `make docs-inventories`. If one
+# is missing, the remote is used instead.
 intersphinx_mapping = {
-    "cmake": ("https://cmake.org/cmake/help/latest", None),
+    "cmake": ("https://cmake.org/cmake/help/latest", ("_inv/cmake.inv", None)),
     "cppref": ("https://en.cppreference.com/w/", CPPREF_GENERATED_INV),
-    "mongodb": ("https://www.mongodb.com/docs/manual", None),
+    "mongodb": ("https://www.mongodb.com/docs/manual", ("_inv/mongodb.inv", None)),
 }
+# Don't let an unresponsive remote stall the build
+intersphinx_timeout = 5
 
 templates_path = ["_templates"]
 exclude_patterns = ["_build", "Thumbs.db", ".DS_Store"]
@@ -210,6 +268,12 @@ rst_prolog = """
 
 .. role:: dbcommand(mongodb:dbcommand)
 
+"""
+
+# Substitutions that are available in every document. These are not part of `rst_prolog`, which would
+# re-parse them for every document: `PrologSubstitutions` parses them once and copies them into each document.
+amongoc_rst_substitutions = """
+
 .. |amongoc| replace:: :project-name:`amongoc`
 .. |attr.transfer| replace:: :doc-attr:`[[transfer]]`
 .. |attr.type| replace:: :doc-attr:`[[type(…)]] <[[type(T)]]>`
@@ -260,6 +324,49 @@ rst_prolog = """
 """
 
 
+class PrologSubstitutions(SphinxTransform):
+    """
+    Define the substitutions from ``amongoc_rst_substitutions`` that are referenced by a document.
+    This runs just before the docutils transform that resolves substitution references.
+    """
+
+    default_priority = 215
+    _cache: "weakref.WeakKeyDictionary[Sphinx, tuple[str, dict[str, nodes.substitution_definition]]]" = (
+        weakref.WeakKeyDictionary()
+    )
+    """
+    For each application: the source text that was parsed, and the parsed definitions by normalized name.
+    These are shared by every document that the application reads.
+    """
+
+    def _load(self) -> dict[str, nodes.substitution_definition]:
+        source: str = self.config.amongoc_rst_substitutions
+        cached = self._cache.get(self.app)
+        if cached is not None and cached[0] == source:
+            return cached[1]
+        doc = docutils.utils.new_document("<rst_prolog>", self.document.settings)
+        Parser().parse(source, doc)
+        defs = {fully_normalize_name(d["names"][0]): d for d in doc.findall(nodes.substitution_definition)}
+        self._cache[self.app] = (source, defs)
+        return defs
+
+    def apply(self, **kwargs: Any) -> None:
+        defs = self._load()
+        wanted = [fully_normalize_name(r["refname"]) for r in self.document.findall(nodes.substitution_reference)]
+        while wanted:
+            name = wanted.pop()
+            # Skip unknown names, and names already defined (by the document itself, or by us)
+            if name not in defs or name in self.document.substitution_names:
+                continue
+            subdef = defs[name].deepcopy()
+            # Cross-references are resolved relative to the document that contains them
+            for xref in subdef.findall(addnodes.pending_xref):
+                xref["refdoc"] = self.env.docname
+            self.document.note_substitution_def(subdef, subdef["names"][0])
+            # Definitions may use other substitutions
+            wanted.extend(fully_normalize_name(r["refname"]) for r in subdef.findall(nodes.substitution_reference))
+
+
 def _parse_header_dir(env: BuildEnvironment, name: str, node: addnodes.desc_signature) -> str:
     node += addnodes.desc_addname("", "<")
     node += addnodes.desc_name(name, name)
@@ -269,8 +376,14 @@ def _parse_header_dir(env: BuildEnvironment, name: str, node: addnodes.desc_sign
     return name
 
 
+_META_ATTR_RE = re.compile(r"^\[\[(.+?)\]\]$")
+"Matches the name of a documentation attribute, e.g. ``[[transfer]]``"
+_EARTHLY_RE = re.compile(r"(\+.+?)(/.*)$", re.ASCII)
+"Matches an Earthly artifact reference, e.g. ``+target/path``. Group 1 is the target, group 2 is the path"
+
+
 def _parse_meta_attr(env: BuildEnvironment, name: str, node: addnodes.desc_signature) -> str:
-    mat = re.match(r"^\[\[(.*)\]\]$", name)
+    mat = _META_ATTR_RE.match(name)
     if not mat:
         raise ValueError(f"Invalid doc-attr name: {name}")
     spel = mat[1]
@@ -288,11 +401,12 @@ def annotator(
     """
     Create a parse_node function that adds a parenthesized annotation to an object signature.
     """
+    text = f"({annot})"
 
     def parse_node(env: BuildEnvironment, sig: str, signode: addnodes.desc_signature) -> str:
         signode += addnodes.desc_name(sig, sig)
         signode += addnodes.desc_sig_space()
-        signode += addnodes.desc_annotation("", f"({annot})")
+        signode += addnodes.desc_annotation("", text)
         return sig
 
     return parse_node
@@ -301,11 +415,12 @@ def annotator(
 def parse_earthly_artifact(env: BuildEnvironment, sig: str, signode: addnodes.desc_signature) -> str:
     """
     Parse and render the signature of an '.. earthly-artifact::' signature"""
-    mat = re.match(r"(?P<target>\+.+?)(?P<path>/.*)$", sig)
+    mat = _EARTHLY_RE.match(sig)
     if not mat:
         raise RuntimeError(f"Invalid earthly-artifact signature: {sig!r} (expected “+<target>/<path> string)")
-    signode += addnodes.desc_addname(mat["target"], mat["target"])
-    signode += addnodes.desc_name(mat["path"], mat["path"])
+    target, path = mat.groups()
+    signode += addnodes.desc_addname(target, target)
+    signode += addnodes.desc_name(path, path)
     signode += addnodes.desc_sig_space()
     signode += addnodes.desc_annotation("", "(Earthly artifact)")
     return sig
@@ -402,14 +517,29 @@ _CONSTANTS = [
 ]
 
 
+# Deduplicate, and put longer names first so that the alternation does not try a shorter prefix before
+# the full name. The regex built by `words` already factors out the shared "amongoc_"/"bson_"/"mlib_"
+# prefixes, so splitting these lists by family would not gain anything.
+_TYPES = tuple(sorted(dict.fromkeys(_TYPES), key=lambda s: (-len(s), s)))
+_FUNCS = tuple(sorted(dict.fromkeys(_FUNCS), key=lambda s: (-len(s), s)))
+_CONSTANTS = tuple(sorted(dict.fromkeys(_CONSTANTS), key=lambda s: (-len(s), s)))
+
+# The alternations are built once here rather than in the token table
+_CONSTANTS_ALT = words(_CONSTANTS, prefix=r"\b", suffix=r"\b")
+_TYPES_ALT = words(_TYPES, prefix=r"\b", suffix=r"\b")
+_FUNCS_ALT = words(_FUNCS, prefix=r"\b", suffix=r"\b")
+# Kept as a pattern string: RegexLexer compiles every rule with the lexer's own flags
+_TYPE_PREFIX_FUNC: str = words(_TYPES).get() + r"_\w+\b"  # type: ignore
+
+
 class CustomCppLexer(CppLexer):
     tokens = {
         "keywords": [
-            (words(_CONSTANTS, suffix=r"\b"), token.Name.Constant),
-            (words(_TYPES, suffix=r"\b"), token.Keyword.Type),
-            (words(_FUNCS, suffix=r"\b"), token.Name.Function),
+            (_CONSTANTS_ALT, token.Name.Constant),
+            (_TYPES_ALT, token.Keyword.Type),
+            (_FUNCS_ALT, token.Name.Function),
             # Lex every other name of the form `<type>_<words>` as a function name
-            (rf"{words(_TYPES).get()}_\w+\b", token.Name.Function),  # type: ignore
+            (_TYPE_PREFIX_FUNC, token.Name.Function),
             # Enumerators
             (r"amongoc_async_\w+\b", token.Name.Constant),
             (r"amongoc_\w_errc_\w+\b", token.Name.Constant),
@@ -424,6 +554,8 @@ class CustomCppLexer(CppLexer):
 
 
 def setup(app: Sphinx):
+    app.add_config_value("amongoc_rst_substitutions", "", "env", str)
+    app.add_transform(PrologSubstitutions)
     app.add_object_type(  # type: ignore
         "header-file",
         "header-file",
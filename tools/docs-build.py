@@ -1,24 +1,87 @@
 import argparse
+import hashlib
+import os
 import shutil
 import subprocess
 import sys
-import tempfile
-from contextlib import ExitStack
 from datetime import datetime
 from pathlib import Path
 from typing import Iterable, Sequence
 
-import sphinx.cmd.build
-
 THIS_FILE = Path(__file__).resolve()
 TOOLS_DIR = THIS_FILE.parent
 REPO_DIR = TOOLS_DIR.parent
+DOCTREE_DIR = REPO_DIR / "_build/sphinx-doctrees"
+"Sphinx's doctree cache. This lives outside of the scratch directory so that it persists between builds."
+MIRROR_DIR = REPO_DIR / "_build/docs-mirror.git"
+"A persistent bare clone of the repository, used for ``--clean-repo-branch`` builds"
+MIRROR_WORKTREE = REPO_DIR / "_build/docs-mirror.worktree"
+"A persistent worktree of `MIRROR_DIR`, where the branch for ``--clean-repo-branch`` is checked out"
+BUILD_HASH_FILE = ".build-hash"
+"Name of the file in the output directory that records the `docs_source_hash` of the sources it was built from"
 
 
 def run(cmd: Iterable[str | Path], *, cwd: Path | None = None) -> None:
     subprocess.check_call(list(map(str, cmd)), cwd=cwd)
 
 
+def docs_source_hash(repo_root: Path) -> str:
+    """
+    Compute a hash of everything that the built pages depend on: the paths and content of every file in the
+    documentation source directory, the locked tool versions, and this script (which sets the Sphinx arguments).
+    """
+    h = hashlib.blake2b()
+
+    def add_file(name: str, fpath: Path) -> None:
+        h.update(name.encode() + b"\0")
+        h.update(fpath.read_bytes())
+        h.update(b"\0")
+
+    add_file("poetry.lock", repo_root / "poetry.lock")
+    add_file("docs-build.py", THIS_FILE)
+    docs_dir = repo_root / "docs"
+    for dirpath, dirnames, filenames in os.walk(docs_dir):
+        # Walk in a stable order, and skip build outputs and bytecode caches
+        dirnames[:] = sorted(d for d in dirnames if d not in ("_build", "__pycache__"))
+        for fname in sorted(filenames):
+            if ".generated." in fname:
+                # Written by conf.py from its own content, which is already part of the hash
+                continue
+            fpath = Path(dirpath, fname)
+            add_file("docs/" + fpath.relative_to(docs_dir).as_posix(), fpath)
+    return h.hexdigest()
+
+
+def checkout_clean_branch(branch: str) -> Path:
+    """
+    Update the repository mirror with the given branch, and check out that branch in the mirror's
+    worktree. Returns the path to the worktree.
+    """
+    if not MIRROR_DIR.is_dir():
+        print(f"Creating repository mirror [{MIRROR_DIR}]")
+        shutil.rmtree(MIRROR_WORKTREE, ignore_errors=True)
+        run(["git", "clone", "--quiet", "--bare", REPO_DIR.as_uri(), MIRROR_DIR])
+    print(f"Fetching [{branch}] into [{MIRROR_DIR}]")
+    run(["git", "-C", MIRROR_DIR, "fetch", "--quiet", "--depth=1", "origin", branch])
+    commit = subprocess.check_output(["git", "-C", str(MIRROR_DIR), "rev-parse", "FETCH_HEAD"], text=True).strip()
+    if MIRROR_WORKTREE.is_dir():
+        # Checkout only rewrites the files that differ, so Sphinx still sees the others as unchanged
+        run(["git", "-C", MIRROR_WORKTREE, "checkout", "--quiet", "--force", "--detach", commit])
+    else:
+        run(["git", "-C", MIRROR_DIR, "worktree", "prune"])
+        run(["git", "-C", MIRROR_DIR, "worktree", "add", "--quiet", "--detach", MIRROR_WORKTREE, commit])
+    return MIRROR_WORKTREE
+
+
+def push_pages(scratch_dir: Path, remote: str, branch: str) -> None:
+    """
+    Push the pages branch in the scratch directory to the remote. This is a no-op if the remote is already
+    up-to-date, so it is also done when nothing new was committed: a prior run may have committed but failed to push.
+    """
+    print("Pushing...")
+    run(["git", "-C", scratch_dir, "push", remote, f"{branch}:{branch}"])
+
+
 def main(argv: Sequence[str]):
     parser = argparse.ArgumentParser(
         description="""Build the amongoc documentation and optionally commit/push the docs"""
@@ -55,6 +118,22 @@ def main(argv: Sequence[str]):
         help="Delete the prior scratch directory if it exists",
         action="store_true",
     )
+    parser.add_argument(
+        "--clean",
+        help="Delete the Sphinx doctree cache before building, forcing every document to be re-read",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        help="Have Sphinx re-read and re-write every document, even those that are unchanged since the prior build",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--force",
+        help="Build even if the output directory was already built from identical sources and tools."
+        " This is implied by --clean and --full-rebuild",
+        action="store_true",
+    )
     parser.add_argument(
         "--push",
         help="Push to the remote branch after building the documentation",
@@ -67,64 +146,98 @@ def main(argv: Sequence[str]):
     remote: str = args.remote
     delete_prior: bool = args.delete_prior
     skip_remote_clone: bool = args.skip_remote_clone
+    clean: bool = args.clean
+    full_rebuild: bool = args.full_rebuild
+    force: bool = args.force
     push: bool = args.push
 
-    with ExitStack() as stack:
-        if clean_repo_branch is None:
-            build_repo_root = REPO_DIR
-        else:
-            build_repo_root = Path(stack.enter_context(tempfile.TemporaryDirectory(suffix=".amongoc-docs-clone")))
-            print(f"Cloning into temporary dir [{build_repo_root}]")
-            run(
-                [
-                    "git",
-                    "clone",
-                    "--quiet",
-                    "--depth=1",
-                    f"--branch={clean_repo_branch}",
-                    REPO_DIR.as_uri(),
-                    build_repo_root,
-                ]
-            )
-
-        if commit_branch is not None:
+    if clean:
+        shutil.rmtree(DOCTREE_DIR, ignore_errors=True)
+    # Sphinx throws away a cached environment that was built from a different source directory, so a
+    # clean clone gets a cache of its own rather than clobbering the one for the working copy.
+    doctree_dir = DOCTREE_DIR / ("working-copy" if clean_repo_branch is None else f"branch/{clean_repo_branch}")
+
+    if clean_repo_branch is None:
+        build_repo_root = REPO_DIR
+    else:
+        build_repo_root = checkout_clean_branch(clean_repo_branch)
+
+    if commit_branch is not None:
+        if delete_prior:
             try:
-                if delete_prior:
-                    shutil.rmtree(scratch_dir)
-                if next(iter(scratch_dir.iterdir()), None) is not None:
-                    raise RuntimeError(f"Scratch directory [{scratch_dir}] is not empty")
+                shutil.rmtree(scratch_dir)
             except FileNotFoundError:
                 pass
-            # Clone the remote
-            if not skip_remote_clone:
-                print(f"Cloning existing pages into [{scratch_dir}]")
-                run(["git", "clone", "--quiet", "--depth=1", f"--branch={commit_branch}", remote, scratch_dir])
-            print("Wiping prior content...")
-            run(["git", "-C", scratch_dir, "rm", "--quiet", "-rf", "."])
-
-        print("Executing sphinx-build...")
-        sphinx.cmd.build.build_main(
-            [
-                "-W",
-                "-jauto",
-                "-qa",
-                "-bdirhtml",
-                f'--doctree-dir={REPO_DIR/"_build/docs-build.doctree"}',
-                str(build_repo_root / "docs"),
-                str(scratch_dir),
-            ]
-        )
-        scratch_dir.joinpath(".nojekyll").write_bytes(b"")
-        print(f"Build pages are in [{scratch_dir}]")
-        if commit_branch is not None:
-            scratch_dir.joinpath(".buildinfo").unlink()
-            print("Staging...")
-            run(["git", "-C", scratch_dir, "add", "."])
+        if skip_remote_clone:
+            # Reuse the existing clone, but don't commit to the wrong branch
+            cur_branch = subprocess.check_output(
+                ["git", "-C", str(scratch_dir), "symbolic-ref", "--short", "HEAD"], text=True
+            ).strip()
+            if cur_branch != commit_branch:
+                raise RuntimeError(
+                    f"Scratch directory [{scratch_dir}] has branch [{cur_branch}] checked out, not [{commit_branch}]"
+                )
+        else:
+            # Check before cloning, rather than letting the clone fail (or succeed) in a bad state
+            scratch_dir.mkdir(parents=True, exist_ok=True)
+            if any(scratch_dir.iterdir()):
+                raise RuntimeError(f"Scratch directory [{scratch_dir}] is not empty")
+            print(f"Cloning existing pages into [{scratch_dir}]")
+            run(["git", "clone", "--quiet", "--depth=1", f"--branch={commit_branch}", remote, scratch_dir])
+
+    source_hash = docs_source_hash(build_repo_root)
+    hash_file = scratch_dir / BUILD_HASH_FILE
+    try:
+        prior_hash = hash_file.read_text().strip()
+    except FileNotFoundError:
+        prior_hash = None
+    if prior_hash == source_hash and not (force or full_rebuild or clean):
+        print(f"Pages in [{scratch_dir}] were already built from these sources. Nothing to build.")
+        if commit_branch is not None and push:
+            push_pages(scratch_dir, remote, commit_branch)
+        return
+    # Don't leave a stale hash in place if the build fails part way
+    hash_file.unlink(missing_ok=True)
+
+    if commit_branch is not None:
+        print("Wiping prior content...")
+        # Only the files are removed here. The deletions are staged along with the new pages by "git add -A".
+        for child in scratch_dir.iterdir():
+            if child.name == ".git":
+                continue
+            if child.is_dir() and not child.is_symlink():
+                shutil.rmtree(child)
+            else:
+                child.unlink()
+
+    print("Executing sphinx-build...")
+    # Imported here since loading Sphinx is slow, and is not needed for --help or an argument error
+    import sphinx.cmd.build
+
+    # Report every warning from the build before failing, rather than stopping at the first one
+    sphinx_args = ["-W", "--keep-going", "-jauto", "-q", "-bdirhtml", f"--doctree-dir={doctree_dir}"]
+    if full_rebuild:
+        sphinx_args.append("-a")
+    rc = sphinx.cmd.build.build_main([*sphinx_args, str(build_repo_root / "docs"), str(scratch_dir)])
+    if rc != 0:
+        return rc
+    nojekyll = scratch_dir / ".nojekyll"
+    if not nojekyll.exists():
+        nojekyll.write_bytes(b"")
+    hash_file.write_text(source_hash + "\n")
+    print(f"Build pages are in [{scratch_dir}]")
+    if commit_branch is not None:
+        scratch_dir.joinpath(".buildinfo").unlink()
+        print("Staging...")
+        run(["git", "-C", scratch_dir, "add", "-A", "."])
+        if subprocess.call(["git", "-C", str(scratch_dir), "diff", "--quiet", "--cached"]) == 0:
+            print("Built pages are unchanged. Nothing to commit.")
+        else:
             today = datetime.now().isoformat()
             print("Committing...")
-            run(["git", "-C", scratch_dir, "commit", "--quiet", "-m", f"Documentation build [{today}]"])
-            if push:
-                run(["git", "-C", scratch_dir, "push", remote, f"{commit_branch}:{commit_branch}"])
+            run(["git", "-C", scratch_dir, "commit", "--quiet", "--no-verify", "-m", f"Documentation build [{today}]"])
+        if push:
+            push_pages(scratch_dir, remote, commit_branch)
 
 
 if __name__ == "__main__":
@@ -1,8 +1,13 @@
 import argparse
-import itertools
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
 from pathlib import Path
 import re
 import sys
+import tempfile
+from typing import Iterable
 
 parser = argparse.ArgumentParser(
     description="Fixup #include directives to use <...> for absolute includes"
@@ -12,52 +17,133 @@ parser.add_argument(
     action="store_true",
     help="Only check the #include formats, do not change anything",
 )
+parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="Process every file, ignoring (and not updating) the cache of files that are already fixed",
+)
 args = parser.parse_args()
 only_check: bool = args.check
+use_cache: bool = not args.no_cache
+
+CACHE_FILE = Path("_build/include-fixup.cache.json")
+"Records the modification time and size of each file that was last seen with proper #include directives"
+CACHE_KEY = hashlib.blake2b(Path(__file__).read_bytes()).hexdigest()
+"""
+A digest of this script, stored in the cache file. The fixup rules are defined in this file, so a cache
+written with a different key may have been judged with different rules, and is discarded.
+"""
+
+Fingerprint = list[int]
+"The [mtime_ns, size] of a file, as stored in the cache"
+
+cache: dict[str, Fingerprint] = {}
+if use_cache:
+    try:
+        cache_data = json.loads(CACHE_FILE.read_text())
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        if isinstance(cache_data, dict) and cache_data.get("key") == CACHE_KEY:
+            cache = cache_data["files"]
 
 
-pats = [
-    "**/*.c",
-    "**/*.h",
-    "**/*.cpp",
-    "**/*.hpp",
-]
+SOURCE_SUFFIXES = {".c", ".h", ".cpp", ".hpp"}
 
 dirs = ["src/", "include/", "tests/", "docs/"]
 
-dirs = map(Path, dirs)
-source_files = itertools.chain.from_iterable(
-    itertools.chain.from_iterable((p.glob(pat) for pat in pats) for p in dirs)
-)
 
-INCLUDE_RE = re.compile(r'(\s*#include\s+)"(\w.*)"(.*)$')
+def scan_sources(dirpath: str | os.PathLike[str]) -> Iterable[Path]:
+    "Recursively yield every C and C++ source file within the given directory"
+    try:
+        entries = os.scandir(dirpath)
+    except FileNotFoundError:
+        return
+    with entries:
+        for ent in entries:
+            if ent.is_dir(follow_symlinks=False):
+                yield from scan_sources(ent.path)
+            elif os.path.splitext(ent.name)[1] in SOURCE_SUFFIXES:
+                yield Path(ent.path)
+
+
+source_files = (f for d in dirs for f in scan_sources(d))
+
+# Matched against the raw file content: C and C++ sources are ASCII where it matters here
+INCLUDE_RE = re.compile(rb'^([ \t]*#include[ \t]+)"(\w[^"\n]*)"(.*)$', re.MULTILINE | re.ASCII)
 
 
 def subst(fpath: Path):
     "Create a regex substitution function that prints a message for the file when a substitution is made"
 
-    def f(mat: re.Match[str]) -> str:
+    def f(mat: re.Match[bytes]) -> bytes:
         # See groups in INCLUDE_RE
-        newl = f"{mat[1]}<{mat[2]}>{mat[3]}"
-        print(f"{fpath}: update #include directive: {mat[0]!r} → {newl!r}")
+        newl = mat[1] + b"<" + mat[2] + b">" + mat[3]
+        print(f"{fpath}: update #include directive: {mat[0].decode()!r} → {newl.decode()!r}")
         return newl
 
     return f
 
 
-err = False
-for fpath in source_files:
-    old_lines = fpath.read_text()
-    new_lines = "\n".join(
-        INCLUDE_RE.sub(subst(fpath), ln) for ln in old_lines.split("\n")
-    )
-    if new_lines == old_lines:
+def fingerprint(fpath: Path) -> Fingerprint:
+    st = fpath.stat()
+    return [st.st_mtime_ns, st.st_size]
+
+
+def replace_content(fpath: Path, content: bytes) -> None:
+    "Atomically replace the content of the given file, keeping its permissions"
+    # Replace the file that a symlink refers to, not the symlink itself
+    target = Path(os.path.realpath(fpath))
+    # A unique name, since the target may also be reached through another path that is processed concurrently
+    fd, tmp_name = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+    tmp = Path(tmp_name)
+    try:
+        with open(fd, "wb") as out:
+            out.write(content)
+        os.chmod(tmp, target.stat().st_mode & 0o777)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def process_file(fpath: Path) -> tuple[bool, Fingerprint | None]:
+    """
+    Fix (or only check, with ``--check``) the #include directives in the given file.
+    Returns whether the file is in error, and the fingerprint to cache for the file
+    if it is now known to be correct.
+    """
+    fp = fingerprint(fpath)
+    if cache.get(str(fpath)) == fp:
+        # Unchanged since it was last seen to be correct
+        return False, fp
+    raw = fpath.read_bytes()
+    if b"#include" not in raw:
+        # INCLUDE_RE cannot match without this substring. Most files will take this path.
+        return False, fp
+    new_content = INCLUDE_RE.sub(subst(fpath), raw)
+    if new_content == raw:
         # Nothing to do
-        continue
+        return False, fp
     if only_check:
         print(f"File [{fpath}] contains improper #include directives", file=sys.stderr)
-        err = True
-    else:
-        fpath.write_text(new_lines, newline="\n")
+        return True, None
+    replace_content(fpath, new_content)
+    return False, fingerprint(fpath)
+
+
+# The work is dominated by file I/O, so overlap it across threads
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+    files = list(source_files)
+    results = list(pool.map(process_file, files))
+err = any(e for e, _ in results)
+
+if use_cache:
+    new_cache = {str(f): fp for f, (_, fp) in zip(files, results) if fp is not None}
+    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = CACHE_FILE.with_name(CACHE_FILE.name + ".tmp")
+    tmp.write_text(json.dumps({"key": CACHE_KEY, "files": new_cache}))
+    os.replace(tmp, CACHE_FILE)
+
 if err:
     sys.exit(1)